@@ -1,62 +1,49 @@
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import from_json, to_json, col, unbase64, base64, split, expr
-from pyspark.sql.types import StructField, StructType, StringType, BooleanType, ArrayType, DateType
-
-# create a StructType for the Kafka redis-server topic which has all changes made to Redis - before Spark 3.0.0, schema inference is not automatic
-kafkaRedisSchema = StructType(
-    [
-        StructField("key", StringType()),
-        StructField("value", StringType()),
-        StructField("expiredType", StringType()),
-        StructField("expiredValue",StringType()),
-        StructField("existType", StringType()),
-        StructField("ch", StringType()),
-        StructField("incr",BooleanType()),
-        StructField("zSetEntries", ArrayType(
-            StructType([
-                StructField("element", StringType()),
-                StructField("score", StringType())
-            ]))
-        )
-    ]
-)
-
-# create a StructType for the Customer JSON that comes from Redis- before Spark 3.0.0, schema inference is not automatic
-customerSchema = StructType (
-    [
-        StructField('customerName', StringType()),
-        StructField('email', StringType()),
-        StructField('phone', StringType()),
-        StructField('birthDay', StringType())
-    ]
-)
-
-# create a StructType for the Kafka stedi-events topic which has the Customer Risk JSON that comes from Redis- before Spark 3.0.0, schema inference is not automatic
-kafkaStediEventSchema = StructType (
-    [
-        StructField("customer", StringType()),
-        StructField("score", StringType()),
-        StructField("riskDate", StringType()),   
-    ]
-)
+from pyspark.sql.functions import from_json, to_json, col, unbase64, base64, substring, expr
+
+# create a schema, as a DDL string, for the Kafka redis-server topic which has all changes made to Redis - before Spark 3.0.0, schema inference is not automatic
+# only the element of the zSetEntries is read further down, so the other fields (key, value, expiredType, expiredValue,
+# existType, ch, incr and the score of the entries) are left out and the JSON parser skips them instead of building them for every record
+kafkaRedisSchema = 'zSetEntries ARRAY<STRUCT<element: STRING>>'
+
+# create a schema, as a DDL string, for the Customer JSON that comes from Redis- before Spark 3.0.0, schema inference is not automatic
+# only email and birthDay are used, customerName and phone are left out so the JSON parser skips them
+customerSchema = 'email STRING, birthDay STRING'
+
+# create a schema, as a DDL string, for the Kafka stedi-events topic which has the Customer Risk JSON that comes from Redis- before Spark 3.0.0, schema inference is not automatic
+kafkaStediEventSchema = 'customer STRING, score STRING, riskDate STRING'
 
 # create a spark application object
-spark = SparkSession.builder.appName('redis-and-stedi-join').getOrCreate()
+# the stream-stream join is the only shuffle, and its state is kept per shuffle partition, so the default 200 partitions
+# would mean 200 tiny tasks and state stores on every micro-batch (a query resuming from an existing checkpoint keeps the partitions it started with)
+spark = SparkSession.builder \
+    .appName('redis-and-stedi-join') \
+    .config('spark.sql.shuffle.partitions', 16) \
+    .getOrCreate()
 
 # set the spark log level to WARN
 spark.sparkContext.setLogLevel('WARN')
 
 # using the spark application object, read a streaming dataframe from the Kafka topic redis-server as the source
+# fetching fewer, larger chunks from the broker per micro-batch (at least 64KB or 200ms per fetch, up to 4MB per partition)
 redisServerRawStreamingDF = spark \
     .readStream \
     .format('kafka') \
     .option('kafka.bootstrap.servers', 'localhost:9092') \
     .option('subscribe', 'redis-server') \
     .option('startingOffsets', 'earliest') \
+    .option('maxOffsetsPerTrigger', 200000) \
+    .option('kafka.fetch.min.bytes', 65536) \
+    .option('kafka.fetch.max.wait.ms', 200) \
+    .option('kafka.max.partition.fetch.bytes', 4 * 1024 * 1024) \
     .load()
 
 # cast the value column in the streaming dataframe as a STRING 
-redisServerStreamingDF = redisServerRawStreamingDF.selectExpr("cast(value as string) value")
+# (from_json only accepts strings, and this cast wraps the Kafka bytes without a UTF-8 validation pass)
+# and drop the payloads that have no zSetEntries before parsing them, a plain substring check is much cheaper than
+# a JSON parse, and records without zSetEntries can never produce a customer further down anyway
+redisServerStreamingDF = redisServerRawStreamingDF.selectExpr("cast(value as string) value") \
+    .where(col('value').contains('"zSetEntries"'))
 
 # parse the single column "value" with a json object in it, like this:
 # +------------+
@@ -82,20 +69,17 @@ redisServerStreamingDF = redisServerRawStreamingDF.selectExpr("cast(value as str
 # (Note: The Redis Source for Kafka has redundant fields zSetEntries and zsetentries, only one should be parsed)
 #
 # and create separated fields like this:
-# +------------+-----+-----------+------------+---------+-----+-----+-----------------+
-# |         key|value|expiredType|expiredValue|existType|   ch| incr|      zSetEntries|
-# +------------+-----+-----------+------------+---------+-----+-----+-----------------+
-# |U29ydGVkU2V0| null|       null|        null|     NONE|false|false|[[dGVzdDI=, 0.0]]|
-# +------------+-----+-----------+------------+---------+-----+-----+-----------------+
+# +------------+
+# | zSetEntries|
+# +------------+
+# |[[dGVzdDI=]]|
+# +------------+
 #
-# storing them in a temporary view called RedisSortedSet
-redisServerStreamingDF.withColumn('value', from_json('value', kafkaRedisSchema)) \
-    .select(col('value.*')) \
-    .createOrReplaceTempView('RedisSortedSet')
-
-# execute a sql statement against a temporary view, which statement takes the element field from the 0th element in the array of structs and create a column called encodedCustomer
-# the reason we do it this way is that the syntax available select against a view is different than a dataframe, and it makes it easy to select the nth element of an array in a sql column
-zSetEntriesEncodedStreamingDF = spark.sql("select zSetEntries[0].element as encodedCustomer from RedisSortedSet")
+# and take the element field from the 0th element in the array of structs as a column called encodedCustomer
+# everything is chained on the dataframe itself, without temporary views in between, so the whole redis side stays one plan
+zSetEntriesEncodedStreamingDF = redisServerStreamingDF \
+    .withColumn('value', from_json('value', kafkaRedisSchema)) \
+    .select(col('value.zSetEntries')[0]['element'].alias('encodedCustomer'))
 
 # take the encodedCustomer column which is base64 encoded at first like this:
 # +--------------------+
@@ -112,24 +96,22 @@ zSetEntriesEncodedStreamingDF = spark.sql("select zSetEntries[0].element as enco
 #+--------------------+
 #
 # with this JSON format: {"customerName":"Sam Test","email":"sam.test@test.com","phone":"8015551212","birthDay":"2001-01-03"}
+# the cast to string takes the decoded bytes as they are, without validating or re-encoding them
 zSetEntriesDecodedStreamingDF = zSetEntriesEncodedStreamingDF \
     .withColumn('customer', unbase64(zSetEntriesEncodedStreamingDF.encodedCustomer).cast('string'))
 
-# parse the JSON in the Customer record and store in a temporary view called CustomerRecords
-zSetEntriesDecodedStreamingDF.withColumn('customer', from_json('customer', customerSchema)) \
-    .select(col('customer.*')).createOrReplaceTempView('CustomerRecords')
+# parse the JSON in the Customer record and select just the fields we want as a new dataframe called emailAndBirthDayStreamingDF
+# (from_json finds both fields whatever their order or spacing in the record, which a regex over the raw string would not)
+# JSON parsing will set non-existent fields to null, so the records without an email or a birthDay are dropped
+# right on the parsed struct, before its fields get expanded into separate columns
+emailAndBirthDayStreamingDF = zSetEntriesDecodedStreamingDF \
+    .withColumn('customer', from_json('customer', customerSchema)) \
+    .where(col('customer.email').isNotNull() & col('customer.birthDay').isNotNull()) \
+    .select(col('customer.email'), col('customer.birthDay'))
 
-# JSON parsing will set non-existent fields to null, so let's select just the fields we want, where they are not null as a new dataframe called emailAndBirthDayStreamingDF
-emailAndBirthDayStreamingDF = spark \
-    .sql("""
-        select email, birthDay 
-        from CustomerRecords 
-        where email is not null and birthDay is not null
-    """)
-
-# Split the birth year as a separate field from the birthday
+# Take the birth year as a separate field from the birthday
 emailAndBirthDayStreamingDF = emailAndBirthDayStreamingDF \
-            .withColumn('birthYear', split(emailAndBirthDayStreamingDF.birthDay,"-").getItem(0))
+            .withColumn('birthYear', substring(emailAndBirthDayStreamingDF.birthDay, 1, 4))
 
 # Select only the birth year and email fields as a new streaming data frame called emailAndBirthYearStreamingDF
 emailAndBirthYearStreamingDF = emailAndBirthDayStreamingDF.select(col('email'), col('birthYear'))
@@ -137,15 +119,22 @@ emailAndBirthYearStreamingDF = emailAndBirthDayStreamingDF.select(col('email'),
 # -------------------------------------------------
 # using the spark application object, read a streaming dataframe from the Kafka topic stedi-events as the source
 # Be sure to specify the option that reads all the events from the topic including those that were published before you started the spark stream
+# (earliest only applies to the first run, a restart resumes from the offsets stored in the checkpoint of the sink)
+# fetching fewer, larger chunks from the broker per micro-batch (at least 64KB or 200ms per fetch, up to 4MB per partition)
 stediEventsRawStreamingDF = spark \
     .readStream \
     .format('kafka') \
     .option('kafka.bootstrap.servers', 'localhost:9092') \
     .option('subscribe', 'stedi-events') \
     .option('startingOffsets', 'earliest') \
+    .option('maxOffsetsPerTrigger', 200000) \
+    .option('kafka.fetch.min.bytes', 65536) \
+    .option('kafka.fetch.max.wait.ms', 200) \
+    .option('kafka.max.partition.fetch.bytes', 4 * 1024 * 1024) \
     .load()
                                    
 # cast the value column in the streaming dataframe as a STRING 
+# (from_json only accepts strings, and this cast wraps the Kafka bytes without a UTF-8 validation pass)
 stediEventsStreamingDF = stediEventsRawStreamingDF.selectExpr("cast(value as string) value")
 
 # parse the JSON from the single column "value" with a json object in it, like this:
@@ -162,19 +151,17 @@ stediEventsStreamingDF = stediEventsRawStreamingDF.selectExpr("cast(value as str
 # |"sam@tes"...| -1.4| 2020-09...|
 # +------------+-----+-----------+
 #
-# storing them in a temporary view called CustomerRisk
-stediEventsStreamingDF.withColumn('value', from_json('value', kafkaStediEventSchema)) \
-    .select(col('value.*')) \
-    .createOrReplaceTempView('CustomerRisk')
-
-# execute a sql statement against a temporary view, selecting the customer and the score from the temporary view, creating a dataframe called customerRiskStreamingDF
-customerRiskStreamingDF = spark.sql("select customer, score from CustomerRisk")
+# selecting the customer and the score straight from the parsed value, creating a dataframe called customerRiskStreamingDF
+customerRiskStreamingDF = stediEventsStreamingDF \
+    .withColumn('value', from_json('value', kafkaStediEventSchema)) \
+    .select(col('value.customer'), col('value.score'))
 
 # -------------------------------------------------
 # join the streaming dataframes on the email address to get the risk score and the birth year in the same dataframe
 customerRiskAndBirthYearDF = customerRiskStreamingDF.join(emailAndBirthYearStreamingDF, expr('customer = email'))
 
 # sink the joined dataframes to a new kafka topic to send the data to the STEDI graph application 
+# firing a micro-batch every 5 seconds rather than as soon as the previous one ends, so each batch carries enough records to amortize its fixed cost
 # +--------------------+-----+--------------------+---------+
 # |            customer|score|               email|birthYear|
 # +--------------------+-----+--------------------+---------+
@@ -190,6 +177,7 @@ customerRiskAndBirthYearDF = customerRiskStreamingDF.join(emailAndBirthYearStrea
 customerRiskAndBirthYearDF \
     .selectExpr('cast(customer as string) as key', 'to_json(struct(*)) as value') \
     .writeStream \
+    .trigger(processingTime='5 seconds') \
     .format('kafka') \
     .option('kafka.bootstrap.servers', 'localhost:9092') \
     .option('topic', 'stedi-risk-score') \
@@ -0,0 +1,115 @@
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import from_json, col, unbase64, substring
+
+# runs the two console streams of sparkpyrediskafkastreamtoconsole.py and sparkpyeventskafkastreamtoconsole.py
+# as two queries of one spark application, so they share a single driver, executors and Kafka consumers
+# instead of starting two applications (see those scripts for the step by step description of each stream)
+
+# create a schema, as a DDL string, for the Kafka redis-server topic which has all changes made to Redis - before Spark 3.0.0, schema inference is not automatic
+# only the element of the zSetEntries is read further down, so the other fields are left out and the JSON parser skips them
+kafkaRedisSchema = 'zSetEntries ARRAY<STRUCT<element: STRING>>'
+
+# create a schema, as a DDL string, for the Customer JSON that comes from Redis- before Spark 3.0.0, schema inference is not automatic
+# only email and birthDay are used, customerName and phone are left out so the JSON parser skips them
+customerSchema = 'email STRING, birthDay STRING'
+
+# create a schema, as a DDL string, for the Kafka stedi-events topic which has the Customer Risk JSON that comes from Redis- before Spark 3.0.0, schema inference is not automatic
+kafkaStediEventSchema = 'customer STRING, score STRING, riskDate STRING'
+
+# create a spark application object
+spark = SparkSession.builder.appName('kafka-redis-and-stedi-events-streams').getOrCreate()
+
+# set the spark log level to WARN
+spark.sparkContext.setLogLevel('WARN')
+
+# -------------------------------------------------
+# read a streaming dataframe from the Kafka topic redis-server as the source, from the beginning on the first run
+# (a restart resumes from the offsets stored in the checkpoint of the sink)
+redisServerRawStreamingDF = spark \
+    .readStream \
+    .format('kafka') \
+    .option('kafka.bootstrap.servers', 'localhost:9092') \
+    .option('subscribe', 'redis-server') \
+    .option('startingOffsets', 'earliest') \
+    .option('maxOffsetsPerTrigger', 200000) \
+    .option('kafka.fetch.min.bytes', 65536) \
+    .option('kafka.fetch.max.wait.ms', 200) \
+    .option('kafka.max.partition.fetch.bytes', 4 * 1024 * 1024) \
+    .load()
+
+# cast the value column as a STRING and drop the payloads that have no zSetEntries before parsing them
+redisServerStreamingDF = redisServerRawStreamingDF.selectExpr("cast(value as string) value") \
+    .where(col('value').contains('"zSetEntries"'))
+
+# parse the redis-server JSON and take the base64 encoded customer from the element field of the 0th zSetEntries
+zSetEntriesEncodedStreamingDF = redisServerStreamingDF \
+    .withColumn('value', from_json('value', kafkaRedisSchema)) \
+    .select(col('value.zSetEntries')[0]['element'].alias('encodedCustomer'))
+
+# decode the customer into clear json like this: {"customerName":"Sam Test","email":"sam.test@test.com","phone":"8015551212","birthDay":"2001-01-03"}
+zSetEntriesDecodedStreamingDF = zSetEntriesEncodedStreamingDF \
+    .withColumn('customer', unbase64(zSetEntriesEncodedStreamingDF.encodedCustomer).cast('string'))
+
+# parse the JSON in the Customer record, keeping only the records with an email and a birthDay,
+# and take the birth year as the first 4 characters of the yyyy-MM-dd birthDay
+emailAndBirthYearStreamingDF = zSetEntriesDecodedStreamingDF \
+    .withColumn('customer', from_json('customer', customerSchema)) \
+    .where(col('customer.email').isNotNull() & col('customer.birthDay').isNotNull()) \
+    .select(col('customer.email'), substring(col('customer.birthDay'), 1, 4).alias('birthYear'))
+
+# -------------------------------------------------
+# read a streaming dataframe from the Kafka topic stedi-events as the source, from the beginning on the first run
+# (a restart resumes from the offsets stored in the checkpoint of the sink)
+stediEventsRawStreamingDF = spark \
+    .readStream \
+    .format('kafka') \
+    .option('kafka.bootstrap.servers', 'localhost:9092') \
+    .option('subscribe', 'stedi-events') \
+    .option('startingOffsets', 'earliest') \
+    .option('maxOffsetsPerTrigger', 200000) \
+    .option('kafka.fetch.min.bytes', 65536) \
+    .option('kafka.fetch.max.wait.ms', 200) \
+    .option('kafka.max.partition.fetch.bytes', 4 * 1024 * 1024) \
+    .load()
+
+# cast the value column as a STRING, parse the JSON and select the customer and the score
+customerRiskStreamingDF = stediEventsRawStreamingDF \
+    .selectExpr("cast(value as string) value") \
+    .withColumn('value', from_json('value', kafkaStediEventSchema)) \
+    .select(col('value.customer'), col('value.score'))
+
+# -------------------------------------------------
+# sink both dataframes to the console in append mode, each query with its own checkpoint,
+# then block until one of them stops
+#
+# The output should look like this:
+# +--------------------+---------+
+# |               email|birthYear|
+# +--------------------+---------+
+# |Gail.Spencer@test...|     1963|
+# +--------------------+---------+
+#
+# +--------------------+-----+
+# |            customer|score|
+# +--------------------+-----+
+# |Spencer.Davis@tes...|  8.0|
+# +--------------------+-----+
+emailAndBirthYearStreamingDF.writeStream \
+    .trigger(processingTime='5 seconds') \
+    .outputMode('append') \
+    .format('console') \
+    .option('checkpointLocation', '/tmp/streamsrediskafkacheckpoint') \
+    .start()
+
+customerRiskStreamingDF.writeStream \
+    .trigger(processingTime='5 seconds') \
+    .outputMode('append') \
+    .format('console') \
+    .option('checkpointLocation', '/tmp/streamseventskafkacheckpoint') \
+    .start()
+
+spark.streams.awaitAnyTermination()
+
+# Run the python script by running the command from the terminal:
+# /home/workspace/submit-kafka-streams-to-console.sh
+# Verify the data looks correct